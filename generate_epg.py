@@ -1,10 +1,23 @@
 import requests
-import xml.etree.ElementTree as ET
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from html import escape
+import time
+from functools import lru_cache
 import logging
 import sys
 import os # Needed for output file path
 
+try:
+    import ijson # Incremental parsing, so XML is written while the EPG is still downloading
+except ImportError:
+    ijson = None
+
+try:
+    import orjson # Much faster JSON decoding for the large EPG payload
+except ImportError:
+    orjson = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -16,143 +29,270 @@ USER_AGENT = (
     'AppleWebKit/537.36 (KHTML, like Gecko) '
     'Chrome/91.0.4472.124 Safari/537.36' # Using a reasonably modern Chrome UA
 )
+# Prefix added to channel ids to match the M3U tvg-id; set CHANNEL_ID_PREFIX="" for the raw API ids
+CHANNEL_ID_PREFIX = os.environ.get("CHANNEL_ID_PREFIX", "LN_")
+# Output is flushed to disk in chunks of this size to keep write() syscalls few and large
+WRITE_BUFFER_SIZE = 1 << 20 # 1 MiB
+# Sidecar files (appended to OUTPUT_FILE) holding the validators for conditional GETs
+CACHE_VALIDATORS = (
+    # (file suffix, response header, conditional request header)
+    (".etag", "ETag", "If-None-Match"),
+    (".lastmod", "Last-Modified", "If-Modified-Since"),
+)
+# Sidecar recording the CHANNEL_ID_PREFIX the output was generated with
+PREFIX_SUFFIX = ".prefix"
 
+@lru_cache(maxsize=None)
+def xmltv_date(day):
+    """Formats a day number (days since the Unix epoch) as a UTC YYYYMMDD string."""
+    t = time.gmtime(day * 86400)
+    return f"{t.tm_year:04d}{t.tm_mon:02d}{t.tm_mday:02d}"
+
+@lru_cache(maxsize=None)
 def unix_to_xmltv(timestamp):
-    """Converts a Unix timestamp (seconds since epoch) to XMLTV UTC format."""
+    """Converts a Unix timestamp (seconds since epoch) to XMLTV UTC format.
+
+    Results are cached, since one programme's end is usually the next one's start.
+    """
     try:
-        dt_object = datetime.utcfromtimestamp(int(float(timestamp)))
-        return dt_object.strftime('%Y%m%d%H%M%S') + " +0000"
-    except (ValueError, TypeError, OverflowError) as e:
+        # Programmes cluster on a few days, so only the date part goes through gmtime;
+        # the time of day is plain integer arithmetic.
+        day, seconds = divmod(int(float(timestamp)), 86400)
+        hours, seconds = divmod(seconds, 3600)
+        minutes, seconds = divmod(seconds, 60)
+        return f"{xmltv_date(day)}{hours:02d}{minutes:02d}{seconds:02d} +0000"
+    except (ValueError, TypeError, OverflowError, OSError) as e:
         logging.error(f"Error converting timestamp '{timestamp}': {e}")
         return None # Indicate failure
 
-def create_xmltv(data):
-    """Creates an XMLTV ElementTree object from the fetched JSON data."""
-    if not isinstance(data, dict) or "channels" not in data or not isinstance(data["channels"], list):
-        logging.error("Invalid data structure received from API: 'channels' key missing or not a list.")
-        return None
-
-    tv = ET.Element("tv")
-    tv.set("generator-info-name", "GitHub Actions EPG Generator")
-    tv.set("generator-info-url", "https://github.com/features/actions")
+@lru_cache(maxsize=4096)
+def escape_text(text):
+    """Escapes XML text content. Cached (bounded) for show titles, which repeat across listings."""
+    return escape(text, quote=False)
 
-    channel_count = 0
-    program_count = 0
-
-    for channel in data["channels"]:
-        if not isinstance(channel, dict) or "_id" not in channel or "name" not in channel:
-            logging.warning(f"Skipping invalid channel entry: {channel}")
-            continue
-
-        # *** FIX: Add the 'LN_' prefix to match the M3U tvg-id ***
-        channel_id = "LN_" + str(channel["_id"])
-        # *** End FIX ***
-
-        channel_name = channel.get("name", "Unknown Channel")
-
-        # Use the modified channel_id here
-        channel_elem = ET.SubElement(tv, "channel", id=channel_id)
-        ET.SubElement(channel_elem, "display-name").text = channel_name
-        channel_count += 1
+def iter_channels(response):
+    """Yields the channel entries of a streamed EPG response as they are parsed."""
+    try:
+        if ijson:
+            response.raw.decode_content = True # Let urllib3 undo gzip/br before ijson sees the bytes
+            yield from ijson.items(response.raw, "channels.item", use_float=True)
+            return
 
-        programs = channel.get("program", [])
-        if not isinstance(programs, list):
-            logging.warning(f"Channel '{channel_name}' ({channel_id}) has invalid 'program' data type. Skipping programs.")
-            continue
+        data = orjson.loads(response.content) if orjson else response.json()
+    except Exception as e:
+        logging.error(f"Error decoding EPG JSON response: {e}")
+        sys.exit(1)
 
-        for program in programs:
-            if not isinstance(program, dict):
-                logging.warning(f"Skipping invalid program entry for channel '{channel_name}' ({channel_id}): {program}")
-                continue
-
-            start_ts = program.get("starts_at")
-            end_ts = program.get("ends_at")
-            title = program.get("program_title")
-
-            if start_ts is None or end_ts is None or title is None:
-                logging.warning(f"Skipping program with missing essential data for channel '{channel_name}' ({channel_id}): {program}")
-                continue
-
-            start_xmltv = unix_to_xmltv(start_ts)
-            stop_xmltv = unix_to_xmltv(end_ts)
-
-            if start_xmltv is None or stop_xmltv is None:
-                logging.warning(f"Skipping program due to timestamp conversion error for channel '{channel_name}' ({channel_id}): {program}")
-                continue
-
-            if start_ts >= end_ts:
-                 logging.warning(f"Skipping program with start time >= end time for channel '{channel_name}' ({channel_id}): {program}")
-                 continue
-
-            # Use the modified channel_id here as well
-            prog_elem = ET.SubElement(
-                tv,
-                "programme",
-                start=start_xmltv,
-                stop=stop_xmltv,
-                channel=channel_id
-            )
-            ET.SubElement(prog_elem, "title", lang="en").text = str(title)
+    if not isinstance(data, dict) or "channels" not in data or not isinstance(data["channels"], list):
+        logging.error("Invalid data structure received from API: 'channels' key missing or not a list.")
+        return
 
-            description = program.get("program_description")
-            if description and str(description).strip():
-                ET.SubElement(prog_elem, "desc", lang="en").text = str(description)
+    yield from data["channels"]
 
-            program_count += 1
+def write_xmltv(filename, channels):
+    """Streams channel entries to an XMLTV file as pre-formatted XML text.
 
-    logging.info(f"Processed {channel_count} channels and {program_count} programs.")
-    if channel_count == 0:
-        logging.warning("No valid channels were processed. Output XML might lack channel definitions.")
-    if program_count == 0:
-        logging.warning("No valid programs were processed. Output XML might lack program details.")
+    The file is written under a temporary name and only moved into place once
+    complete, so a failed run never truncates the previous output.
+    Returns False if no valid channels were found and nothing was written.
+    """
+    channel_count = 0
+    program_count = 0
+    tmp_filename = filename + ".tmp"
 
-    return ET.ElementTree(tv)
+    # Bind hot callables as locals to skip global/attribute lookups in the programme loop
+    warn = logging.warning
+    to_xmltv = unix_to_xmltv
+    esc = escape
+    esc_text = escape_text
 
-def save_xmltv_file(filename, xml_tree):
-    """Saves the XMLTV ElementTree to a file."""
     try:
-        ET.indent(xml_tree, space="  ", level=0)
-        xml_tree.write(filename, encoding='UTF-8', xml_declaration=True)
-        logging.info(f"Successfully wrote XMLTV data to {filename}")
+        # Text mode lets the C io layer do the UTF-8 encoding in large chunks
+        with open(tmp_filename, 'w', encoding='utf-8', newline='', buffering=WRITE_BUFFER_SIZE) as f:
+            write = f.write
+            write(
+                "<?xml version='1.0' encoding='UTF-8'?>\n"
+                '<tv generator-info-name="GitHub Actions EPG Generator" generator-info-url="https://github.com/features/actions">\n'
+            )
+            for channel in channels:
+                if not isinstance(channel, dict) or "_id" not in channel or "name" not in channel:
+                    warn(f"Skipping invalid channel entry: {channel}")
+                    continue
+
+                # *** FIX: Add the prefix ('LN_' by default) to match the M3U tvg-id ***
+                channel_id = CHANNEL_ID_PREFIX + str(channel["_id"])
+                # *** End FIX ***
+                # Escaped once here and reused for every programme of this channel
+                channel_attr = esc(channel_id)
+
+                channel_name = channel.get("name", "Unknown Channel")
+
+                # A null name is written as an empty <display-name>, like the old ElementTree output
+                display_name = esc_text(str(channel_name)) if channel_name is not None else ""
+
+                # Use the modified channel_id here
+                write(
+                    f'<channel id="{channel_attr}">\n'
+                    f'  <display-name>{display_name}</display-name>\n'
+                    f'</channel>\n'
+                )
+                channel_count += 1
+
+                programs = channel.get("program", [])
+                if not isinstance(programs, list):
+                    warn(f"Channel '{channel_name}' ({channel_id}) has invalid 'program' data type. Skipping programs.")
+                    continue
+
+                for program in programs:
+                    # Well-formed programmes are the norm, so let the rare bad entry raise
+                    # instead of type/key checking every one up front
+                    try:
+                        start_ts = program["starts_at"]
+                        end_ts = program["ends_at"]
+                        title = program["program_title"]
+                    except (KeyError, TypeError):
+                        warn(f"Skipping invalid program entry or program with missing essential data for channel '{channel_name}' ({channel_id}): {program}")
+                        continue
+
+                    if start_ts is None or end_ts is None or title is None:
+                        warn(f"Skipping program with missing essential data for channel '{channel_name}' ({channel_id}): {program}")
+                        continue
+
+                    try:
+                        start_xmltv = to_xmltv(start_ts)
+                        stop_xmltv = to_xmltv(end_ts)
+                    except TypeError:
+                        # Unhashable timestamp (e.g. a list) can't go through the cache
+                        start_xmltv = stop_xmltv = None
+
+                    if start_xmltv is None or stop_xmltv is None:
+                        warn(f"Skipping program due to timestamp conversion error for channel '{channel_name}' ({channel_id}): {program}")
+                        continue
+
+                    if start_ts >= end_ts:
+                         warn(f"Skipping program with start time >= end time for channel '{channel_name}' ({channel_id}): {program}")
+                         continue
+
+                    # Use the modified channel_id here as well
+                    programme = (
+                        f'<programme start="{start_xmltv}" stop="{stop_xmltv}" channel="{channel_attr}">\n'
+                        f'  <title lang="en">{esc_text(str(title))}</title>\n'
+                    )
+
+                    description = program.get("program_description")
+                    if description and str(description).strip():
+                        # Descriptions are mostly unique per episode, so caching them would only cost memory
+                        programme += f'  <desc lang="en">{esc(str(description), quote=False)}</desc>\n'
+
+                    write(programme)
+                    write('</programme>\n')
+                    program_count += 1
+
+            write("</tv>\n")
+
+        logging.info(f"Processed {channel_count} channels and {program_count} programs.")
+        if channel_count == 0:
+            logging.error("No valid channels were processed. Keeping existing output file.")
+            return False
+        if program_count == 0:
+            logging.warning("No valid programs were processed. Output XML might lack program details.")
+
+        os.replace(tmp_filename, filename)
     except IOError as e:
         logging.error(f"Error writing XML file '{filename}': {e}")
         sys.exit(1)
     except Exception as e:
         logging.error(f"An unexpected error occurred during XML writing: {e}")
         sys.exit(1)
+    finally:
+        unix_to_xmltv.cache_clear()
+        xmltv_date.cache_clear()
+        escape_text.cache_clear()
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+    logging.info(f"Successfully wrote XMLTV data to {filename}")
+    return True
+
+
+def create_session():
+    """Creates a keep-alive HTTP session that retries transient gateway errors."""
+    session = requests.Session()
+    session.headers.update({'User-Agent': USER_AGENT})
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+    session.mount('https://', HTTPAdapter(pool_maxsize=4, max_retries=retries))
+    return session
+
+def load_cache_headers(filename):
+    """Builds conditional request headers from the validators saved alongside the output file."""
+    headers = {}
+    if not os.path.exists(filename):
+        return headers # Nothing to revalidate, always fetch the full EPG
+
+    # A 304 would keep ids generated with a different prefix, so refetch instead
+    try:
+        with open(filename + PREFIX_SUFFIX, encoding='utf-8') as f:
+            saved_prefix = f.read().rstrip("\n")
+    except OSError:
+        saved_prefix = None
+    if saved_prefix != CHANNEL_ID_PREFIX:
+        logging.info("Channel id prefix changed since last run, fetching the full EPG")
+        return headers
+
+    for suffix, _, header in CACHE_VALIDATORS:
+        try:
+            with open(filename + suffix, encoding='utf-8') as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value:
+            headers[header] = value
+    return headers
 
+def save_cache_headers(filename, response):
+    """Stores the response's ETag/Last-Modified and the channel id prefix next to the output file.
+
+    All files are always written (empty if the header is missing) so the
+    workflow's commit step can rely on them existing.
+    """
+    try:
+        with open(filename + PREFIX_SUFFIX, 'w', encoding='utf-8') as f:
+            f.write(CHANNEL_ID_PREFIX + "\n")
+    except OSError as e:
+        logging.warning(f"Could not update cache validator file '{filename + PREFIX_SUFFIX}': {e}")
+
+    for suffix, header, _ in CACHE_VALIDATORS:
+        path = filename + suffix
+        value = response.headers.get(header) or ""
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(value + "\n")
+        except OSError as e:
+            logging.warning(f"Could not update cache validator file '{path}': {e}")
 
 def main():
     """Main function to fetch data, convert, and save."""
-    headers = {
-        'User-Agent': USER_AGENT
-    }
+    with create_session() as session:
+        logging.info(f"Fetching EPG data from {API_URL}")
+        try:
+            response = session.get(API_URL, headers=load_cache_headers(OUTPUT_FILE), timeout=45, stream=True)
+            response.raise_for_status()
 
-    logging.info(f"Fetching EPG data from {API_URL}")
-    try:
-        response = requests.get(API_URL, headers=headers, timeout=45)
-        response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Failed to fetch EPG data: {e}")
+            sys.exit(1)
 
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Failed to fetch EPG data: {e}")
-        sys.exit(1)
+        if response.status_code == 304:
+            logging.info(f"EPG data not modified since last run, keeping existing {OUTPUT_FILE}")
+            return
 
-    logging.info(f"Successfully fetched EPG data (Status: {response.status_code})")
+        logging.info(f"Connected to EPG feed (Status: {response.status_code}), streaming data")
 
-    try:
-        data = response.json()
-    except ValueError as e:
-        logging.error(f"Error decoding EPG JSON response: {e}")
-        logging.debug(f"Response text (first 500 chars): {response.text[:500]}...")
-        sys.exit(1)
+        if not write_xmltv(OUTPUT_FILE, iter_channels(response)):
+            logging.error("XMLTV generation failed. No output file generated.")
+            sys.exit(1)
 
-    xmltv_tree = create_xmltv(data)
-
-    if xmltv_tree:
-        save_xmltv_file(OUTPUT_FILE, xmltv_tree)
-    else:
-        logging.error("XMLTV Tree creation failed. No output file generated.")
-        sys.exit(1)
+        save_cache_headers(OUTPUT_FILE, response)
 
 if __name__ == "__main__":
     main()